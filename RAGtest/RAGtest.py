@@ -1,16 +1,30 @@
 import os
+import sys
 import json
-import time
-import requests
+import asyncio
+import aiohttp
+import orjson
 from dotenv import load_dotenv
+from aiolimiter import AsyncLimiter
+
+# 讓各資料夾下的腳本都找得到 repo 根目錄的 common/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.llm import (
+    DEFAULT_QPS, EndpointPool, endpoints_from_env,
+    BudgetExceeded, track_usage,
+    cache_get, cache_set, backoff_delay, is_retryable_status,
+    get_logger,
+)
+
+logger = get_logger("rag.test")
 
 # === 設定 ===
 API_URL = "https://outer-medusa.genai.nchc.org.tw/v1/chat/completions"
 MODEL = "gpt-oss-120b"  # 依 NCHC 實際可用模型調整
+CONCURRENCY = 10  # 同時在途的請求數
 TEMPERATURE = 0.2
 TIMEOUT = 60
-RETRY = 3
-RETRY_WAIT = 2  # 秒
+RETRY = 6
 
 # 載入 .env（建議在 .env 內放 API_KEY=xxxxx）
 load_dotenv()
@@ -22,12 +36,29 @@ HEADERS = {
     "accept": "application/json",
 }
 
+# token bucket：所有請求（含重試）共用，把速率壓在 QPS 上限（環境變數 QPS 可調）
+LIMITER = AsyncLimiter(max_rate=DEFAULT_QPS, time_period=1)
+
+# 端點池：主端點 + FALLBACK_API_URL 備援（有設的話），出錯自動切換
+POOL = EndpointPool(endpoints_from_env(API_URL, HEADERS))
+
 
 # === System prompt ===
 SYSTEM_PROMPT = ("You are a reasoning assistant."
                  "Always follow the rules strictly and output valid JSON only."
 )
 
+# 靜態 system 訊息只建一次，每個 payload 重複引用同一個 dict；
+# 設 PROMPT_CACHE=1 會加上 cache_control 註記，讓支援 prompt caching 的
+# 端點重用這段固定前綴的 KV cache
+if os.getenv("PROMPT_CACHE") == "1":
+    SYSTEM_MSG = {
+        "role": "system",
+        "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    }
+else:
+    SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
 # === User prompt template ===
 USER_TEMPLATE = """TASK
 - You will be given two inputs:
@@ -42,11 +73,11 @@ USER_TEMPLATE = """TASK
 
 OUTPUT FORMAT
 Return your answer as a JSON object with the following fields:
-{{
+{
   "statement": "<the input statement>",
   "answer": "True" | "False",
   "reasoning": "<explain whether you relied on RAG, your own knowledge, or noticed a conflict between them>"
-}}
+}
 
 INPUT
 Context passage:
@@ -58,26 +89,49 @@ Statement:
 {statement}
 """
 
+# 模板在 import 時就切好：組 prompt 只剩純字串串接，
+# 不必每次呼叫都讓 str.format 重新掃描整個模板（JSON 範例的大括號也不用跳脫了）
+_TPL_HEAD, _rest = USER_TEMPLATE.split("{context}")
+_TPL_MID, _TPL_TAIL = _rest.split("{statement}")
+
 
-def call_model(context: str, statement: str):
+async def call_model(session, context: str, statement: str):
     # 把 context 和 statement 填入模板
-    user_content = USER_TEMPLATE.format(context=context, statement=statement)
+    user_content = _TPL_HEAD + context + _TPL_MID + statement + _TPL_TAIL
 
     payload = {
         "model": MODEL,
         "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
+            SYSTEM_MSG,
             {"role": "user", "content": user_content},
         ],
         "temperature": TEMPERATURE,
+        # 伺服器端 JSON mode：約束解碼保證輸出合法 JSON
+        "response_format": {"type": "json_object"},
     }
 
+    # 先查快取（LLM_CACHE=1 時），命中就不打 API
+    cached = cache_get(payload)
+    if cached is not None:
+        return cached
+
+    # payload 只序列化一次：重試時直接重送同一份 bytes（HEADERS 已帶 Content-Type）
+    body = orjson.dumps(payload)
+
     last_err = None
     for attempt in range(1, RETRY + 1):
+        # 每次 attempt 重新挑端點：上次失敗的端點已被隔離
+        ep, url, headers = POOL.pick()
         try:
-            resp = requests.post(API_URL, headers=HEADERS, json=payload, timeout=TIMEOUT)
-            resp.raise_for_status()
-            data = resp.json()
+            async with LIMITER:
+                async with session.post(
+                    url, headers=headers, data=body,
+                    timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+                ) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json()
+
+            track_usage(data)  # 累計 token 用量；超過 MAX_COST_USD 會丟 BudgetExceeded
 
             # 嘗試取出模型輸出文字
             try:
@@ -85,57 +139,86 @@ def call_model(context: str, statement: str):
             except (KeyError, IndexError, TypeError):
                 content = json.dumps(data, ensure_ascii=False)
 
-            # 🖨️ 印出模型的原始輸出
-            print("\n=== Model Output (raw content) ===")
-            print(content)
-            print("=================================\n")
+            # 原始輸出走 debug log（LOGLEVEL=DEBUG 才落檔），不佔 stdout
+            logger.debug("model output:\n%s", content)
 
             # 嘗試解析成 JSON
             parsed = None
             try:
                 parsed = json.loads(content)
             except json.JSONDecodeError:
-                print("⚠️ 輸出不是合法 JSON，請檢查模型回覆")
+                logger.warning("輸出不是合法 JSON，請檢查模型回覆：%s", content)
                 parsed = None
 
+            cache_set(payload, (parsed, content))
             return parsed, content
 
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientResponseError as e:
             last_err = e
+            # 非 429 的 4xx 表示請求本身有問題，fail fast
+            if not is_retryable_status(e.status):
+                raise
+            POOL.mark_failure(ep)
             if attempt < RETRY:
-                time.sleep(RETRY_WAIT)
+                await asyncio.sleep(backoff_delay(attempt, e.headers.get("Retry-After")))
             else:
                 raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_err = e
+            POOL.mark_failure(ep)
+            if attempt < RETRY:
+                await asyncio.sleep(backoff_delay(attempt))
+            else:
+                raise
+        except BudgetExceeded:
+            # 預算爆了就不要再重試，直接往上拋
+            raise
         except Exception as e:
             last_err = e
             if attempt < RETRY:
-                time.sleep(RETRY_WAIT)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
                 raise
 
     raise RuntimeError(f"呼叫模型失敗：{last_err}")
 
-def main(context: str, statement: str, output_path="RAGtest/rag_conflict_results.json"):
+async def run_batch(pairs, output_path="RAGtest/rag_conflict_results.json"):
+    """
+    一次測多組 (context, statement)：所有請求共用同一條 TLS 連線併發送出，
+    在迴圈裡重複呼叫也不會每次重新握手。回傳 [(parsed, raw_text), ...]。
+    """
     try:
-        parsed, raw_text = call_model(context, statement)
-        result = {
-            "context": context,
-            "statement": statement,
-            "model_output": parsed if parsed else raw_text
-        }
-
-        # 以 "追加模式" 寫入，每次新增一行
-        with open(output_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            outcomes = await asyncio.gather(
+                *(call_model(session, context, statement) for context, statement in pairs)
+            )
 
-        print(f"✅ 已追加結果到 {output_path}")
+        # 以 "追加模式" 寫入，每組一行
+        with open(output_path, "a", encoding="utf-8") as f:
+            for (context, statement), (parsed, raw_text) in zip(pairs, outcomes):
+                result = {
+                    "context": context,
+                    "statement": statement,
+                    "model_output": parsed if parsed else raw_text
+                }
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+        print(f"✅ 已追加 {len(pairs)} 筆結果到 {output_path}")
+        return outcomes
     except Exception as e:
         print(f"❌ 發生錯誤：{e}")
+        return None
+
+async def main(context: str, statement: str, output_path="RAGtest/rag_conflict_results.json"):
+    # 單組測試的便利介面
+    outcomes = await run_batch([(context, statement)], output_path)
+    return outcomes[0] if outcomes else None
 
 if __name__ == "__main__":
-    # 在這裡換不同的 context 和 statement 測試
+    # 在這裡換不同的 context 和 statement 測試；要一次測多組就直接呼叫 run_batch
     context = (
        "Wednesday, January 7th, 2026: Local News Update\nMatt Read is no longer a member of the University of Western Ontario as of Thursday, January 1, 2026, marking a significant change in his affiliation with the institution just days ago."
     )
     statement = "Matt Read was appointed chancellor of the University of Western Ontario on January 1, 2026."
-    main(context, statement)
+    asyncio.run(main(context, statement))
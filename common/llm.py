@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import atexit
+import queue
+import random
+import hashlib
+import logging
+import logging.handlers
+
+import requests
+from diskcache import Cache
+
+# === 日誌 ===
+# 熱路徑用 print 每筆都同步 flush stdout，還會跟 tqdm 進度條互相蓋行。
+# 改走 logging：worker 只做一次非阻塞的 QueueHandler enqueue，背景的
+# QueueListener 再寫進檔案；stdout 留給 tqdm。LOGLEVEL / LOG_FILE 環境變數可調。
+LOG_LEVEL = os.getenv("LOGLEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "rag.log")
+
+_log_listener = None
+
+def get_logger(name="rag"):
+    """回傳掛在 "rag" 底下的 logger；第一次呼叫時啟動背景 QueueListener。"""
+    global _log_listener
+    if _log_listener is None:
+        log_queue = queue.SimpleQueue()
+        handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+        )
+        _log_listener = logging.handlers.QueueListener(log_queue, handler)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+        root = logging.getLogger("rag")
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(LOG_LEVEL)
+    return logging.getLogger(name)
+
+# === 批次大小 ===
+class AIMDBatchSizer:
+    """AIMD（加法增、乘法減）批次大小控制：成功 +1、失敗砍半。
+    批次太大容易吃 5xx/逾時且失敗代價高，太小則固定開銷佔比變高；
+    這樣會自動收斂到端點當下負載的甜蜜點。"""
+
+    def __init__(self, initial, lo=4, hi=40):
+        self.size = max(lo, min(hi, initial))
+        self.lo = lo
+        self.hi = hi
+
+    def record_success(self):
+        self.size = min(self.hi, self.size + 1)
+
+    def record_failure(self):
+        self.size = max(self.lo, self.size // 2)
+
+# === Batch API ===
+# 離線工作（likelihood / trueOrFalse）不在乎延遲，若端點有 OpenAI 相容的
+# /v1/batches，整包丟過去通常有約五折的計價。設 BATCH_API=1 啟用。
+USE_BATCH_API = os.getenv("BATCH_API") == "1"
+BATCH_POLL_INTERVAL = 60  # 秒
+BATCH_COMPLETION_WINDOW = "24h"
+
+class BatchAPIUnsupported(Exception):
+    """端點沒有 /v1/batches（或不接受我們的請求格式）。"""
+
+def run_batch_api(api_url, headers, payloads, poll_interval=BATCH_POLL_INTERVAL):
+    """把 {custom_id: chat-completions payload} 整包送進 Batch API，
+    輪詢到完成後回傳 {custom_id: 回應 body dict}（失敗的 custom_id 不會出現，
+    由呼叫端用即時模式補跑）。端點不支援時丟 BatchAPIUnsupported。"""
+    base = api_url.rsplit("/chat/completions", 1)[0]
+    auth = {"Authorization": headers["Authorization"]}
+
+    lines = []
+    for custom_id, payload in payloads.items():
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": payload,
+        }, ensure_ascii=False))
+    blob = ("\n".join(lines) + "\n").encode("utf-8")
+
+    # 1) 上傳輸入檔
+    resp = requests.post(
+        f"{base}/files", headers=auth,
+        files={"file": ("batch_input.jsonl", blob)},
+        data={"purpose": "batch"}, timeout=120,
+    )
+    if resp.status_code == 404:
+        raise BatchAPIUnsupported(f"{base}/files 回 404")
+    resp.raise_for_status()
+    file_id = resp.json()["id"]
+
+    # 2) 建立 batch
+    resp = requests.post(
+        f"{base}/batches", headers=auth,
+        json={
+            "input_file_id": file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": BATCH_COMPLETION_WINDOW,
+        }, timeout=120,
+    )
+    if resp.status_code == 404:
+        raise BatchAPIUnsupported(f"{base}/batches 回 404")
+    resp.raise_for_status()
+    batch_id = resp.json()["id"]
+    print(f"📦 Batch 已送出：{batch_id}（{len(payloads)} 筆），每 {poll_interval}s 輪詢一次")
+
+    # 3) 輪詢直到結束
+    while True:
+        resp = requests.get(f"{base}/batches/{batch_id}", headers=auth, timeout=120)
+        resp.raise_for_status()
+        info = resp.json()
+        status = info.get("status")
+        if status in ("completed", "failed", "expired", "cancelled"):
+            break
+        time.sleep(poll_interval)
+    if status != "completed":
+        raise RuntimeError(f"Batch {batch_id} 結束於狀態 {status}")
+
+    # 4) 下載輸出並按 custom_id 整理
+    out_file = info.get("output_file_id")
+    if not out_file:
+        raise RuntimeError(f"Batch {batch_id} 完成但沒有 output_file_id")
+    resp = requests.get(f"{base}/files/{out_file}/content", headers=auth, timeout=300)
+    resp.raise_for_status()
+
+    results = {}
+    for line in resp.text.splitlines():
+        if not line.strip():
+            continue
+        rec = json.loads(line)
+        response = rec.get("response") or {}
+        if response.get("status_code") == 200:
+            results[rec["custom_id"]] = response["body"]
+    return results
+
+# === 請求速率 ===
+# 客戶端先把 QPS 壓在 NCHC 限額以下，比事後吃 429 再重試便宜得多。
+# 各腳本以 aiolimiter.AsyncLimiter(DEFAULT_QPS, 1) 套用。
+DEFAULT_QPS = int(os.getenv("QPS", "10"))
+
+# === 用量與預算 ===
+# OpenAI 相容回應都帶 usage；累計 token 數並按單價換算花費，
+# 超過 MAX_COST_USD 就整個 job 乾淨地停掉（checkpoint 都在，之後可續跑）。
+PRICE_PROMPT = float(os.getenv("PRICE_PROMPT_PER_1M", "0"))          # USD / 1M prompt tokens
+PRICE_COMPLETION = float(os.getenv("PRICE_COMPLETION_PER_1M", "0"))  # USD / 1M completion tokens
+MAX_COST_USD = float(os.getenv("MAX_COST_USD", "0"))  # 0 = 不設限
+
+TOKENS = {"prompt": 0, "completion": 0}
+
+class BudgetExceeded(Exception):
+    """累計花費超過 MAX_COST_USD。"""
+
+def current_cost():
+    """目前累計的估計花費（USD）。"""
+    return (TOKENS["prompt"] * PRICE_PROMPT
+            + TOKENS["completion"] * PRICE_COMPLETION) / 1_000_000
+
+def track_usage(data):
+    """把一筆回應的 usage 累計進 TOKENS；超過預算就丟 BudgetExceeded。"""
+    usage = data.get("usage") or {}
+    TOKENS["prompt"] += usage.get("prompt_tokens") or 0
+    TOKENS["completion"] += usage.get("completion_tokens") or 0
+    cost = current_cost()
+    if MAX_COST_USD and cost > MAX_COST_USD:
+        raise BudgetExceeded(f"已花費約 ${cost:.2f}，超過上限 ${MAX_COST_USD:.2f}")
+    return cost
+
+# === 多端點容錯 ===
+# 單一 NCHC 端點一掛整個 job 就停；設 FALLBACK_API_URL / FALLBACK_API_KEY
+# 可加一個 OpenAI 相容備援端點，round-robin 分流並在出錯時自動切換。
+ENDPOINT_COOLDOWN = 60  # 秒；端點出錯後的隔離時間
+
+class EndpointPool:
+    """在多個 OpenAI 相容端點間 round-robin；出錯的端點隔離 cooldown 秒，
+    期間請求都走其他端點。全部都在隔離中時退回主端點硬送（總比放棄好）。"""
+
+    def __init__(self, endpoints, cooldown=ENDPOINT_COOLDOWN):
+        self.endpoints = endpoints  # [(url, headers), ...]
+        self.cooldown = cooldown
+        self._down_until = [0.0] * len(endpoints)
+        self._i = 0
+
+    def pick(self):
+        """回傳 (index, url, headers)，優先給健康的端點。"""
+        now = time.monotonic()
+        for _ in range(len(self.endpoints)):
+            i = self._i % len(self.endpoints)
+            self._i += 1
+            if self._down_until[i] <= now:
+                url, headers = self.endpoints[i]
+                return i, url, headers
+        url, headers = self.endpoints[0]
+        return 0, url, headers
+
+    def mark_failure(self, i):
+        self._down_until[i] = time.monotonic() + self.cooldown
+
+def endpoints_from_env(primary_url, primary_headers):
+    """主端點加上環境變數指定的備援端點（沒設就只有主端點）。"""
+    endpoints = [(primary_url, primary_headers)]
+    fallback_url = os.getenv("FALLBACK_API_URL")
+    if fallback_url:
+        headers = dict(primary_headers)
+        headers["Authorization"] = f"Bearer {os.getenv('FALLBACK_API_KEY', '')}"
+        endpoints.append((fallback_url, headers))
+    return endpoints
+
+# === 重試策略 ===
+# 429/5xx/逾時這類暫時性錯誤才值得重試；其他 4xx（例如 payload 有問題）重試也不會過。
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+def is_retryable_status(status):
+    return status in RETRYABLE_STATUS or status >= 500
+
+def backoff_delay(attempt, retry_after=None, cap=60.0):
+    """第 attempt 次失敗（從 1 起算）後的等待秒數：指數退避加亂數 jitter，
+    避免多個 worker 同時重試造成突波；伺服器有給 Retry-After 就以它為準。"""
+    if retry_after is not None:
+        try:
+            return min(cap, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    return min(cap, 2 ** attempt) + random.random()
+
+# === 回應快取 ===
+# TEMPERATURE 很低時同一個 payload 的回應幾乎固定，重跑腳本時沒必要重新打 API。
+# 設環境變數 LLM_CACHE=1 啟用；key 是整個 payload（model/temperature/messages）的 SHA-256。
+CACHE_ENABLED = os.getenv("LLM_CACHE") == "1"
+CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./.llm_cache")
+CACHE_EXPIRE = 7 * 86400  # 秒
+
+_cache = Cache(CACHE_DIR) if CACHE_ENABLED else None
+
+def cache_key(payload):
+    """以 payload 內容算出確定性的快取 key。"""
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()
+    return hashlib.sha256(blob).hexdigest()
+
+def cache_get(payload):
+    """命中回傳快取值，未啟用或未命中回傳 None。"""
+    if _cache is None:
+        return None
+    return _cache.get(cache_key(payload))
+
+def cache_set(payload, value):
+    if _cache is not None:
+        _cache.set(cache_key(payload), value, expire=CACHE_EXPIRE)
@@ -1,18 +1,34 @@
 import os
+import sys
 import json
-import time
-import requests
+import hashlib
+import asyncio
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 from tqdm import tqdm
+from aiolimiter import AsyncLimiter
+
+# 讓各資料夾下的腳本都找得到 repo 根目錄的 common/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.llm import (
+    DEFAULT_QPS, USE_BATCH_API, AIMDBatchSizer, BatchAPIUnsupported, run_batch_api,
+    EndpointPool, endpoints_from_env,
+    BudgetExceeded, track_usage, current_cost,
+    cache_get, cache_set, backoff_delay, is_retryable_status,
+    get_logger,
+)
+
+logger = get_logger("rag.likelihood")
 
 # === 設定 ===
 API_URL = "https://outer-medusa.genai.nchc.org.tw/v1/chat/completions"
 MODEL = "gpt-oss-120b"  # 請依 NCHC 可用模型調整
 BATCH_SIZE = 20  # 每批處理幾條 description，可視情況調整
+CONCURRENCY = 20  # 同時在途的請求數，可視 NCHC 配額調整
 TEMPERATURE = 0.2
 TIMEOUT = 60
-RETRY = 3
-RETRY_WAIT = 2  # 秒
+RETRY = 6
 
 # 載入 .env（建議在 .env 內放 API_KEY=xxxxx）
 load_dotenv()
@@ -24,6 +40,12 @@ HEADERS = {
     "accept": "application/json",
 }
 
+# token bucket：所有 worker（含重試）共用，把請求平滑到 QPS 上限（環境變數 QPS 可調）
+LIMITER = AsyncLimiter(max_rate=DEFAULT_QPS, time_period=1)
+
+# 端點池：主端點 + FALLBACK_API_URL 備援（有設的話），出錯自動切換
+POOL = EndpointPool(endpoints_from_env(API_URL, HEADERS))
+
 # 系統提示：要求只用我們定義的 JSON 結構回答
 SYSTEM_PROMPT = (
    "Analyze whether the following event description could realistically occur in 2026. Return STRICT JSON ONLY with the required schema. Do not include extra text."
@@ -57,74 +79,116 @@ USER_INSTRUCTIONS = (
     "- Answer in English.\n"
 )
 
-def call_model(items_batch):
-    """
-    給模型一批 items（list of dict: {id, description}），回傳解析後的 JSON dict：
-    { "results": [ {id, possible_in_2026, likelihood, rationale}, ... ] }
-    """
+# 靜態 system 訊息只建一次，每個 payload 重複引用同一個 dict；
+# 設 PROMPT_CACHE=1 會加上 cache_control 註記，讓支援 prompt caching 的
+# 端點重用這段固定前綴的 KV cache，省掉每批重算 prefill
+if os.getenv("PROMPT_CACHE") == "1":
+    SYSTEM_MSG = {
+        "role": "system",
+        "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    }
+else:
+    SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+def build_payload(items_batch):
     # 組合用戶訊息：把批次的 items 放進去
-    user_content = USER_INSTRUCTIONS + "\nInput:\n" + json.dumps(items_batch, ensure_ascii=False, indent=2)
+    # compact 分隔符：indent=2 的換行縮排會多收約 1.5 倍的 prompt token，純浪費
+    user_content = USER_INSTRUCTIONS + "\nInput:\n" + json.dumps(items_batch, ensure_ascii=False, separators=(",", ":"))
 
-    payload = {
+    return {
         "model": MODEL,
         "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
+            SYSTEM_MSG,
             {"role": "user", "content": user_content},
         ],
         "temperature": TEMPERATURE,
-        # 若對方支援 JSON 模式可以啟用（不確定 NCHC 是否支援，先保留）
-        # "response_format": {"type": "json_object"}
+        # 伺服器端 JSON mode：約束解碼保證輸出合法 JSON，比解析失敗後整批重試便宜
+        "response_format": {"type": "json_object"},
     }
 
+def parse_response(data):
+    """從 OpenAI 相容回應取出文字並解析成 { "results": [...] }。"""
+    # 依 OpenAI 相容格式取文字
+    content = None
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        # 不符合預期格式，改存 raw
+        content = json.dumps(data, ensure_ascii=False)
+
+    # 解析 content 成 JSON（JSON mode 下伺服器保證合法，不再需要撈大括號救援）
+    try:
+        parsed = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"回應不是有效 JSON，raw content:\n{content}") from e
+
+    # 期望有 results 陣列
+    if not isinstance(parsed, dict) or "results" not in parsed or not isinstance(parsed["results"], list):
+        raise ValueError(f"回應 JSON 結構不符預期：{json.dumps(parsed, ensure_ascii=False)}")
+
+    return parsed
+
+async def call_model(session, items_batch):
+    """
+    給模型一批 items（list of dict: {id, description}），回傳解析後的 JSON dict：
+    { "results": [ {id, possible_in_2026, likelihood, rationale}, ... ] }
+    """
+    payload = build_payload(items_batch)
+
+    # 先查快取（LLM_CACHE=1 時），命中就不打 API
+    cached = cache_get(payload)
+    if cached is not None:
+        return cached
+
+    # payload 只序列化一次：重試時直接重送同一份 bytes，
+    # 不讓 aiohttp 在每次 attempt 都重新編碼（HEADERS 已帶 Content-Type）
+    body = orjson.dumps(payload)
+
     last_err = None
     for attempt in range(1, RETRY + 1):
+        # 每次 attempt 重新挑端點：上次失敗的端點已被隔離
+        ep, url, headers = POOL.pick()
         try:
-            resp = requests.post(API_URL, headers=HEADERS, json=payload, timeout=TIMEOUT)
-            resp.raise_for_status()
-
-            # 嘗試解析 JSON 回應
-            data = resp.json()
-
-            # 依 OpenAI 相容格式取文字
-            content = None
-            try:
-                content = data["choices"][0]["message"]["content"]
-            except (KeyError, IndexError, TypeError):
-                # 不符合預期格式，改存 raw
-                content = json.dumps(data, ensure_ascii=False)
-
-            # 解析 content 成 JSON（模型應該回 STRICT JSON）
-            try:
-                parsed = json.loads(content)
-            except json.JSONDecodeError:
-                # 若模型沒遵守，退而求其次：嘗試從回應裡找第一個 { 開始到最後一個 } 的區段
-                # 以提高健壯性（但仍可能失敗）
-                start = content.find("{")
-                end = content.rfind("}")
-                if start != -1 and end != -1 and end > start:
-                    try:
-                        parsed = json.loads(content[start:end+1])
-                    except json.JSONDecodeError as e:
-                        raise ValueError(f"回應不是有效 JSON，raw content:\n{content}") from e
-                else:
-                    raise ValueError(f"回應不是有效 JSON，raw content:\n{content}")
+            async with LIMITER:
+                async with session.post(
+                    url, headers=headers, data=body,
+                    timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+                ) as resp:
+                    resp.raise_for_status()
 
-            # 期望有 results 陣列
-            if not isinstance(parsed, dict) or "results" not in parsed or not isinstance(parsed["results"], list):
-                raise ValueError(f"回應 JSON 結構不符預期：{json.dumps(parsed, ensure_ascii=False)}")
+                    # 嘗試解析 JSON 回應
+                    data = await resp.json()
 
+            track_usage(data)  # 累計 token 用量；超過 MAX_COST_USD 會丟 BudgetExceeded
+            parsed = parse_response(data)
+
+            cache_set(payload, (parsed, data))
             return parsed, data  # (解析後, 原始完整回應)
 
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientResponseError as e:
+            last_err = e
+            # 非 429 的 4xx 表示請求本身有問題，fail fast
+            if not is_retryable_status(e.status):
+                raise
+            POOL.mark_failure(ep)
+            if attempt < RETRY:
+                await asyncio.sleep(backoff_delay(attempt, e.headers.get("Retry-After")))
+            else:
+                raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             last_err = e
+            POOL.mark_failure(ep)
             if attempt < RETRY:
-                time.sleep(RETRY_WAIT)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
                 raise
+        except BudgetExceeded:
+            # 預算爆了就不要再重試，直接往上拋停掉整個 job
+            raise
         except Exception as e:
             last_err = e
             if attempt < RETRY:
-                time.sleep(RETRY_WAIT)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
                 raise
 
@@ -132,8 +196,8 @@ def call_model(items_batch):
     raise RuntimeError(f"呼叫模型失敗：{last_err}")
 
 def load_input(path):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
     if not isinstance(data, list):
         raise ValueError("input.json 需為陣列，每一筆包含 {id, description}")
     # 基本檢查
@@ -142,32 +206,178 @@ def load_input(path):
             raise ValueError(f"第 {i} 筆缺少 id 或 description：{item}")
     return data
 
-def save_json(path, obj):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+def save_jsonl(path, records):
+    # 逐筆寫 JSONL：orjson 比標準 json 快數倍，也不用先在記憶體組出整包縮排字串；
+    # 每行獨立可解析，下游不必整檔載入
+    with open(path, "wb") as f:
+        for rec in records:
+            f.write(orjson.dumps(rec))
+            f.write(b"\n")
 
 def chunked(lst, size):
     for i in range(0, len(lst), size):
         yield lst[i:i+size]
 
-def main(input_path="/Users/allisonchang/Desktop/yago2026/yago2026_descriptions.json", output_path="2026_likelihood_output.json", raw_log_path="2026_likelihood_raw_responses.jsonl"):
+def dedup_items(items):
+    """相同的 description 只送模型一次；回傳 (去重後 items, 原始 id -> 代表 id)。
+    YAGO 描述是模板生成的，重複比例不低，去重直接省下等比例的 API 呼叫。"""
+    unique = []
+    rep_of = {}
+    seen = {}  # description 的 sha1 -> 代表 id
+    for it in items:
+        h = hashlib.sha1(it["description"].encode("utf-8")).hexdigest()
+        if h in seen:
+            rep_of[it["id"]] = seen[h]
+        else:
+            seen[h] = it["id"]
+            rep_of[it["id"]] = it["id"]
+            unique.append({"id": it["id"], "description": it["description"]})
+    return unique, rep_of
+
+def batch_id_of(batch):
+    """由批次內容算出確定性的 batch_id，作為 checkpoint 的 key。"""
+    blob = json.dumps(batch, ensure_ascii=False, sort_keys=True).encode()
+    return hashlib.sha256(blob).hexdigest()[:16]
+
+def load_checkpoint(path):
+    """讀回已完成的結果：{str(item_id): result}；寫到一半的行直接略過。
+    以 item 為單位（而非批次內容的 hash），批次怎麼切都不影響續跑。"""
+    done = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                for res in rec["results"]:
+                    done[str(res.get("id"))] = res
+    return done
+
+async def main(input_path="/Users/allisonchang/Desktop/yago2026/yago2026_descriptions.json", output_path="2026_likelihood_output.jsonl", raw_log_path="2026_likelihood_raw_responses.jsonl", checkpoint_path="2026_likelihood_checkpoint.jsonl", false_output_path="2026_possible_false.jsonl"):
     try:
-        items = load_input(input_path)
-        all_results = []
+        orig_items = load_input(input_path)
+
+        # ♻️ 先去重：重複的 description 只問一次，結果最後再展開回每個原始 id
+        items, rep_of = dedup_items(orig_items)
+        if len(items) < len(orig_items):
+            print(f"♻️ description 去重：{len(orig_items)} → {len(items)} 筆")
+
+        # ✅ checkpoint 是 source of truth：中斷後重跑只補缺的項目
+        done = load_checkpoint(checkpoint_path)
+        if done:
+            print(f"🔁 從 checkpoint 續跑：{len(done)} 筆已完成")
 
-        with open(raw_log_path, "w", encoding="utf-8") as raw_fp:
-            # ✅ tqdm 進度條：總批次數量
-            for batch in tqdm(list(chunked(items, BATCH_SIZE)), desc="分析進度"):
-                parsed, raw = call_model(batch)
-                all_results.extend(parsed["results"])
-                raw_fp.write(json.dumps(raw, ensure_ascii=False) + "\n")
+        # 批次大小讓 AIMD 自己調：成功 +1、5xx/逾時砍半
+        sizer = AIMDBatchSizer(BATCH_SIZE)
+
+        connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+        # 有界 queue：producer 邊切批邊送，滿了就等 worker 消化（backpressure），
+        # 不必先把所有批次攤在記憶體裡，第一個請求也能最早送出
+        q = asyncio.Queue(maxsize=2 * CONCURRENCY)
+
+        with open(raw_log_path, "ab") as raw_fp, \
+             open(checkpoint_path, "ab") as ckpt_fp:
+
+            # 📦 BATCH_API=1：先把缺的批次整包丟給離線 Batch API（約五折計價），
+            # 失敗或不支援的部分再交給下面的即時模式補跑
+            if USE_BATCH_API:
+                not_done = [it for it in items if str(it["id"]) not in done]
+                if not_done:
+                    payloads = {}
+                    for batch in chunked(not_done, BATCH_SIZE):
+                        payloads[batch_id_of(batch)] = build_payload(batch)
+                    try:
+                        responses = run_batch_api(API_URL, HEADERS, payloads)
+                        for bid, data in responses.items():
+                            parsed = parse_response(data)
+                            rec = {"batch_id": bid, "results": parsed["results"]}
+                            ckpt_fp.write(orjson.dumps(rec) + b"\n")
+                            raw_fp.write(orjson.dumps(data) + b"\n")
+                            for res in parsed["results"]:
+                                done[str(res.get("id"))] = res
+                        ckpt_fp.flush()
+                        os.fsync(ckpt_fp.fileno())
+                    except BatchAPIUnsupported as e:
+                        print(f"⚠️ 端點不支援 Batch API（{e}），退回即時模式")
+
+            pending = [it for it in items if str(it["id"]) not in done]
+
+            async def run_one(session, batch):
+                parsed, raw = await call_model(session, batch)
+                # 每完成一批就落盤，中斷最多只損失在途批次
+                rec = {"batch_id": batch_id_of(batch), "results": parsed["results"]}
+                ckpt_fp.write(orjson.dumps(rec) + b"\n")
+                ckpt_fp.flush()
+                os.fsync(ckpt_fp.fileno())
+                raw_fp.write(orjson.dumps(raw) + b"\n")
+                for res in parsed["results"]:
+                    done[str(res.get("id"))] = res
+
+            async def producer():
+                i = 0
+                while i < len(pending):
+                    size = sizer.size  # 每批大小跟著 AIMD 走
+                    await q.put(pending[i:i+size])
+                    i += size
+                for _ in range(CONCURRENCY):
+                    await q.put(None)  # 收工訊號
+
+            async def worker(session, pbar):
+                while True:
+                    batch = await q.get()
+                    if batch is None:
+                        return
+                    try:
+                        await run_one(session, batch)
+                    except BudgetExceeded:
+                        raise  # 預算爆了：乾淨停掉（checkpoint 都在，可續跑）
+                    except Exception as e:
+                        # 批次失敗不中斷整個 job：縮小批次、items 留給下次續跑
+                        sizer.record_failure()
+                        # 走 logger 才不會跟 tqdm 進度條互相蓋行
+                        logger.warning("批次失敗（%d 筆，下批縮到 %d）：%s", len(batch), sizer.size, e)
+                    else:
+                        sizer.record_success()
+                    pbar.update(len(batch))
+                    pbar.set_postfix(cost=f"${current_cost():.2f}")
+
+            async with aiohttp.ClientSession(connector=connector) as session:
+                with tqdm(total=len(pending), desc="分析進度") as pbar:
+                    await asyncio.gather(
+                        producer(),
+                        *[worker(session, pbar) for _ in range(CONCURRENCY)],
+                    )
+
+        # 最終輸出：把去重後的結果展開回所有原始 id（照原輸入順序），
+        # 同一趟順便過濾 possible_in_2026 = false（不必像以前再整檔重讀一次）
+        all_results = []
+        n_false = 0
+        with open(false_output_path, "wb") as false_fp:
+            for orig in orig_items:
+                res = done.get(str(rep_of[orig["id"]]))
+                if res is None:
+                    logger.warning("找不到 id=%s 的結果（模型可能漏回）", orig["id"])
+                    continue
+                item = {**res, "id": orig["id"]}
+                all_results.append(item)
+                if item.get("possible_in_2026") is False:
+                    false_fp.write(orjson.dumps({
+                        "id": item["id"],
+                        "likelihood": item["likelihood"],
+                        "rationale": item["rationale"],
+                    }) + b"\n")
+                    n_false += 1
 
-        output = {"results": all_results}
-        save_json(output_path, output)
+        save_jsonl(output_path, all_results)
         print(f"\n✅ 已完成，輸出：{output_path}；原始回應紀錄：{raw_log_path}")
+        print(f"🚫 不可能事件：{n_false} 筆 → {false_output_path}")
 
     except Exception as e:
         print(f"❌ 發生錯誤：{e}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,30 +1,36 @@
 import json
 
+import ijson
+
+# ⚠️ 備援腳本：2026_likelihood.py 現在會在跑完時直接輸出 2026_possible_false.jsonl，
+# 這支只在需要從「既有的」完整輸出 JSON 重新過濾時才用得到。
+
 # 輸入檔案與輸出檔案路徑
 input_path = "2026_likelihood_output.json"
 output_path = "2026_possible_false.json"
 
 def filter_false_entries(input_file, output_file):
-    # 讀取原始 JSON
-    with open(input_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    # 過濾出 possible_in_2026 = false 的資料
-    false_entries = [
-        {
-            "id": item["id"],
-            "likelihood": item["likelihood"],
-            "rationale": item["rationale"]
-        }
-        for item in data["results"]
-        if item.get("possible_in_2026") is False
-    ]
+    count = 0
 
-    # 存成新的 JSON
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(false_entries, f, ensure_ascii=False, indent=2)
+    # 用 ijson 串流解析：一次只在記憶體保留一筆 result，
+    # 不必整檔 json.load 進來（大檔才跑得動），輸出也邊過濾邊寫
+    with open(input_file, "rb") as f, open(output_file, "w", encoding="utf-8") as out:
+        out.write("[")
+        for item in ijson.items(f, "results.item"):
+            if item.get("possible_in_2026") is False:
+                if count:
+                    out.write(",\n")
+                else:
+                    out.write("\n")
+                out.write(json.dumps({
+                    "id": item["id"],
+                    "likelihood": item["likelihood"],
+                    "rationale": item["rationale"],
+                }, ensure_ascii=False, indent=2))
+                count += 1
+        out.write("\n]" if count else "]")
 
-    print(f"已輸出 {len(false_entries)} 筆資料到 {output_file}")
+    print(f"已輸出 {count} 筆資料到 {output_file}")
 
 # 執行
 filter_false_entries(input_path, output_path)
@@ -1,18 +1,34 @@
 import os
+import sys
 import json
-import time
-import requests
+import hashlib
+import asyncio
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 from tqdm import tqdm
+from aiolimiter import AsyncLimiter
+
+# 讓各資料夾下的腳本都找得到 repo 根目錄的 common/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.llm import (
+    DEFAULT_QPS, USE_BATCH_API, AIMDBatchSizer, BatchAPIUnsupported, run_batch_api,
+    EndpointPool, endpoints_from_env,
+    BudgetExceeded, track_usage, current_cost,
+    cache_get, cache_set, backoff_delay, is_retryable_status,
+    get_logger,
+)
+
+logger = get_logger("rag.trueorfalse")
 
 # === 設定 ===
 API_URL = "https://outer-medusa.genai.nchc.org.tw/v1/chat/completions"
 MODEL = "gpt-oss-120b"  # 依 NCHC 實際可用模型調整
 BATCH_SIZE = 20
+CONCURRENCY = 20  # 同時在途的請求數，可視 NCHC 配額調整
 TEMPERATURE = 0.2
 TIMEOUT = 60
-RETRY = 3
-RETRY_WAIT = 2  # 秒
+RETRY = 6
 
 # 載入 .env（建議在 .env 內放 API_KEY=xxxxx）
 load_dotenv()
@@ -24,6 +40,12 @@ HEADERS = {
     "accept": "application/json",
 }
 
+# token bucket：所有 worker（含重試）共用，把請求平滑到 QPS 上限（環境變數 QPS 可調）
+LIMITER = AsyncLimiter(max_rate=DEFAULT_QPS, time_period=1)
+
+# 端點池：主端點 + FALLBACK_API_URL 備援（有設的話），出錯自動切換
+POOL = EndpointPool(endpoints_from_env(API_URL, HEADERS))
+
 # === Prompts ===
 SYSTEM_PROMPT = (
     "You are a data transformation assistant. "
@@ -57,8 +79,9 @@ GENERATION RULES
 - Do NOT include analysis or explanations—output JSON only.
 
 OUTPUT FORMAT
-- Return a single JSON ARRAY (not prose). The array length must be exactly 4 × len(Input).
-- Each element is an object:
+- Return a single JSON OBJECT of the form {"results": [...]}.
+- The "results" array length must be exactly 4 × len(Input).
+- Each element of "results" is an object:
   {
     "id": "<original-id>_<suffix>",  // suffix ∈ {"highly_likely","possible","unlikely","highly_unlikely"}
     "statement": "<the generated true/false statement>",
@@ -71,85 +94,123 @@ VALIDATION
 """
 )
 
-def call_model(items_batch):
-    """
-    傳入一批 items（list of dict: {id, description}），要求模型回傳 JSON array，
-    其中每個 input 產出 4 筆（共 4*len(batch) 筆）。
-    """
-    user_content = USER_INSTRUCTIONS + "\nInput:\n" + json.dumps(items_batch, ensure_ascii=False, indent=2)
+# 靜態 system 訊息只建一次，每個 payload 重複引用同一個 dict；
+# 設 PROMPT_CACHE=1 會加上 cache_control 註記，讓支援 prompt caching 的
+# 端點重用這段固定前綴的 KV cache，省掉每批重算 prefill
+if os.getenv("PROMPT_CACHE") == "1":
+    SYSTEM_MSG = {
+        "role": "system",
+        "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    }
+else:
+    SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+def build_payload(items_batch):
+    # compact 分隔符：indent=2 的換行縮排會多收約 1.5 倍的 prompt token，純浪費
+    user_content = USER_INSTRUCTIONS + "\nInput:\n" + json.dumps(items_batch, ensure_ascii=False, separators=(",", ":"))
 
-    payload = {
+    return {
         "model": MODEL,
         "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
+            SYSTEM_MSG,
             {"role": "user", "content": user_content},
         ],
         "temperature": TEMPERATURE,
-        # 若對方支援 JSON 模式可考慮啟用（NCHC 端如支援 OpenAI json_object）
-        # "response_format": {"type": "json_object"}  # 這行改為 array 就不適用，故先關閉
+        # 伺服器端 JSON mode：約束解碼保證輸出合法 JSON，比解析失敗後整批重試便宜
+        # （json_object 不能回頂層 array，所以 prompt 改要求 {"results":[...]} 再在客戶端拆開）
+        "response_format": {"type": "json_object"},
     }
 
+def parse_response(data):
+    """從 OpenAI 相容回應取出文字並解析、標準化成 JSON array。"""
+    # 取出文字
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        content = json.dumps(data, ensure_ascii=False)
+
+    # 解析（JSON mode 下伺服器保證合法，不再需要撈括號救援）：
+    # 預期 {"results":[...]}；也容忍直接回 array 的舊行為
+    try:
+        parsed = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON content:\n{content}") from e
+
+    # 標準化為 array
+    if isinstance(parsed, dict) and "results" in parsed:
+        parsed = parsed["results"]
+    if not isinstance(parsed, list):
+        raise ValueError(f"Expected JSON array, got: {type(parsed)}")
+
+    return parsed
+
+async def call_model(session, items_batch):
+    """
+    傳入一批 items（list of dict: {id, description}），要求模型回傳 JSON array，
+    其中每個 input 產出 4 筆（共 4*len(batch) 筆）。
+    """
+    payload = build_payload(items_batch)
+
+    # 先查快取（LLM_CACHE=1 時），命中就不打 API
+    cached = cache_get(payload)
+    if cached is not None:
+        return cached
+
+    # payload 只序列化一次：重試時直接重送同一份 bytes，
+    # 不讓 aiohttp 在每次 attempt 都重新編碼（HEADERS 已帶 Content-Type）
+    body = orjson.dumps(payload)
+
     last_err = None
     for attempt in range(1, RETRY + 1):
+        # 每次 attempt 重新挑端點：上次失敗的端點已被隔離
+        ep, url, headers = POOL.pick()
         try:
-            resp = requests.post(API_URL, headers=HEADERS, json=payload, timeout=TIMEOUT)
-            resp.raise_for_status()
-            data = resp.json()
-
-            # 取出文字
-            try:
-                content = data["choices"][0]["message"]["content"]
-            except (KeyError, IndexError, TypeError):
-                content = json.dumps(data, ensure_ascii=False)
-
-            # 解析：預期是一個 JSON array；同時容忍 {"results":[...]} 的情況
-            parsed = None
-            try:
-                parsed = json.loads(content)
-            except json.JSONDecodeError:
-                start = content.find("[")
-                end = content.rfind("]")
-                if start != -1 and end != -1 and end > start:
-                    parsed = json.loads(content[start:end+1])
-                else:
-                    # 再嘗試 dict
-                    start = content.find("{")
-                    end = content.rfind("}")
-                    if start != -1 and end != -1 and end > start:
-                        maybe = json.loads(content[start:end+1])
-                        if isinstance(maybe, dict) and "results" in maybe:
-                            parsed = maybe["results"]
-                        else:
-                            raise ValueError(f"Invalid JSON content:\n{content}")
-                    else:
-                        raise ValueError(f"Invalid JSON content:\n{content}")
+            async with LIMITER:
+                async with session.post(
+                    url, headers=headers, data=body,
+                    timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+                ) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json()
 
-            # 標準化為 array
-            if isinstance(parsed, dict) and "results" in parsed:
-                parsed = parsed["results"]
-            if not isinstance(parsed, list):
-                raise ValueError(f"Expected JSON array, got: {type(parsed)}")
+            track_usage(data)  # 累計 token 用量；超過 MAX_COST_USD 會丟 BudgetExceeded
+            parsed = parse_response(data)
 
+            cache_set(payload, (parsed, data))
             return parsed, data  # (本批結果 array, 原始回應)
 
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientResponseError as e:
+            last_err = e
+            # 非 429 的 4xx 表示請求本身有問題，fail fast
+            if not is_retryable_status(e.status):
+                raise
+            POOL.mark_failure(ep)
+            if attempt < RETRY:
+                await asyncio.sleep(backoff_delay(attempt, e.headers.get("Retry-After")))
+            else:
+                raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             last_err = e
+            POOL.mark_failure(ep)
             if attempt < RETRY:
-                time.sleep(RETRY_WAIT)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
                 raise
+        except BudgetExceeded:
+            # 預算爆了就不要再重試，直接往上拋停掉整個 job
+            raise
         except Exception as e:
             last_err = e
             if attempt < RETRY:
-                time.sleep(RETRY_WAIT)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
                 raise
 
     raise RuntimeError(f"呼叫模型失敗：{last_err}")
 
 def load_input(path):
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
     if not isinstance(data, list):
         raise ValueError("input JSON 必須是陣列，每筆包含 {id, description}")
     for i, item in enumerate(data):
@@ -157,44 +218,195 @@ def load_input(path):
             raise ValueError(f"第 {i} 筆缺少 id 或 description：{item}")
     return data
 
-def save_json(path, obj):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+def save_jsonl(path, records):
+    # 逐筆寫 JSONL：orjson 比標準 json 快數倍，也不用先在記憶體組出整包縮排字串；
+    # 每行獨立可解析，下游不必整檔載入
+    with open(path, "wb") as f:
+        for rec in records:
+            f.write(orjson.dumps(rec))
+            f.write(b"\n")
 
 def chunked(lst, size):
     for i in range(0, len(lst), size):
         yield lst[i:i+size]
 
-def main(
+# 模型輸出的 id 後綴（見 USER_INSTRUCTIONS 的 OUTPUT FORMAT）
+# 注意順序：長的要先比對，否則 "_highly_unlikely" 會被 "_unlikely" 誤切
+ID_SUFFIXES = ("highly_unlikely", "highly_likely", "unlikely", "possible")
+
+def split_result_id(rid):
+    """把 '<原始-id>_<suffix>' 拆回 (原始 id, suffix)；拆不出來就原樣回傳。"""
+    for s in ID_SUFFIXES:
+        tail = "_" + s
+        if rid.endswith(tail):
+            return rid[:-len(tail)], s
+    return rid, None
+
+def dedup_items(items):
+    """相同的 description 只送模型一次；回傳 (去重後 items, 原始 id -> 代表 id)。
+    YAGO 描述是模板生成的，重複比例不低，去重直接省下等比例的 API 呼叫。"""
+    unique = []
+    rep_of = {}
+    seen = {}  # description 的 sha1 -> 代表 id
+    for it in items:
+        h = hashlib.sha1(it["description"].encode("utf-8")).hexdigest()
+        if h in seen:
+            rep_of[it["id"]] = seen[h]
+        else:
+            seen[h] = it["id"]
+            rep_of[it["id"]] = it["id"]
+            unique.append({"id": it["id"], "description": it["description"]})
+    return unique, rep_of
+
+def batch_id_of(batch):
+    """由批次內容算出確定性的 batch_id，作為 checkpoint 的 key。"""
+    blob = json.dumps(batch, ensure_ascii=False, sort_keys=True).encode()
+    return hashlib.sha256(blob).hexdigest()[:16]
+
+def load_checkpoint(path):
+    """讀回已完成的結果：{代表 id: [(suffix, rec), ...]}；寫到一半的行直接略過。
+    以 item 為單位（而非批次內容的 hash），批次怎麼切都不影響續跑。"""
+    done = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                for res in rec["results"]:
+                    rep, suffix = split_result_id(str(res.get("id", "")))
+                    done.setdefault(rep, []).append((suffix, res))
+    return done
+
+async def main(
     input_path="yago2026_possible.json",
-    output_path="true_false_output.json",
+    output_path="true_false_output.jsonl",
     raw_log_path="true_false_raw_responses.jsonl",
+    checkpoint_path="true_false_checkpoint.jsonl",
     only_first_10=False
 ):
     try:
-        items = load_input(input_path)
+        orig_items = load_input(input_path)
 
         # ⛳ 若只想跑前 10：
         if only_first_10:
-            items = items[:10]
+            orig_items = orig_items[:10]
 
-        all_results = []
+        # ♻️ 先去重：重複的 description 只問一次，結果最後再展開回每個原始 id
+        items, rep_of = dedup_items(orig_items)
+        if len(items) < len(orig_items):
+            print(f"♻️ description 去重：{len(orig_items)} → {len(items)} 筆")
 
-        with open(raw_log_path, "w", encoding="utf-8") as raw_fp:
-            batches = list(chunked(items, BATCH_SIZE))
-            for batch in tqdm(batches, desc="分析進度"):
-                parsed_array, raw = call_model(batch)
+        # ✅ checkpoint 是 source of truth：中斷後重跑只補缺的項目
+        done = load_checkpoint(checkpoint_path)
+        if done:
+            print(f"🔁 從 checkpoint 續跑：{len(done)} 筆已完成")
+
+        # 批次大小讓 AIMD 自己調：成功 +1、5xx/逾時砍半
+        sizer = AIMDBatchSizer(BATCH_SIZE)
+
+        connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+        # 有界 queue：producer 邊切批邊送，滿了就等 worker 消化（backpressure），
+        # 不必先把所有批次攤在記憶體裡，第一個請求也能最早送出
+        q = asyncio.Queue(maxsize=2 * CONCURRENCY)
+
+        with open(raw_log_path, "ab") as raw_fp, \
+             open(checkpoint_path, "ab") as ckpt_fp:
+
+            # 📦 BATCH_API=1：先把缺的批次整包丟給離線 Batch API（約五折計價），
+            # 失敗或不支援的部分再交給下面的即時模式補跑
+            if USE_BATCH_API:
+                not_done = [it for it in items if str(it["id"]) not in done]
+                if not_done:
+                    payloads = {}
+                    for batch in chunked(not_done, BATCH_SIZE):
+                        payloads[batch_id_of(batch)] = build_payload(batch)
+                    try:
+                        responses = run_batch_api(API_URL, HEADERS, payloads)
+                        for bid, data in responses.items():
+                            parsed_array = parse_response(data)
+                            rec = {"batch_id": bid, "results": parsed_array}
+                            ckpt_fp.write(orjson.dumps(rec) + b"\n")
+                            raw_fp.write(orjson.dumps(data) + b"\n")
+                            for res in parsed_array:
+                                rep, suffix = split_result_id(str(res.get("id", "")))
+                                done.setdefault(rep, []).append((suffix, res))
+                        ckpt_fp.flush()
+                        os.fsync(ckpt_fp.fileno())
+                    except BatchAPIUnsupported as e:
+                        print(f"⚠️ 端點不支援 Batch API（{e}），退回即時模式")
+
+            pending = [it for it in items if str(it["id"]) not in done]
+
+            async def run_one(session, batch):
+                parsed_array, raw = await call_model(session, batch)
 
                 # 期望 4 × len(batch) 筆
                 expected = 4 * len(batch)
                 if len(parsed_array) != expected:
-                    # 不終止流程，但警告
-                    print(f"⚠️ 批次輸出數量不符：got {len(parsed_array)} expected {expected}")
+                    # 不終止流程，但警告（走 logger 才不會跟 tqdm 互相蓋行）
+                    logger.warning("批次輸出數量不符：got %d expected %d", len(parsed_array), expected)
 
-                all_results.extend(parsed_array)
-                raw_fp.write(json.dumps(raw, ensure_ascii=False) + "\n")
+                # 每完成一批就落盤，中斷最多只損失在途批次
+                rec = {"batch_id": batch_id_of(batch), "results": parsed_array}
+                ckpt_fp.write(orjson.dumps(rec) + b"\n")
+                ckpt_fp.flush()
+                os.fsync(ckpt_fp.fileno())
+                raw_fp.write(orjson.dumps(raw) + b"\n")
+                for res in parsed_array:
+                    rep, suffix = split_result_id(str(res.get("id", "")))
+                    done.setdefault(rep, []).append((suffix, res))
+
+            async def producer():
+                i = 0
+                while i < len(pending):
+                    size = sizer.size  # 每批大小跟著 AIMD 走
+                    await q.put(pending[i:i+size])
+                    i += size
+                for _ in range(CONCURRENCY):
+                    await q.put(None)  # 收工訊號
+
+            async def worker(session, pbar):
+                while True:
+                    batch = await q.get()
+                    if batch is None:
+                        return
+                    try:
+                        await run_one(session, batch)
+                    except BudgetExceeded:
+                        raise  # 預算爆了：乾淨停掉（checkpoint 都在，可續跑）
+                    except Exception as e:
+                        # 批次失敗不中斷整個 job：縮小批次、items 留給下次續跑
+                        sizer.record_failure()
+                        logger.warning("批次失敗（%d 筆，下批縮到 %d）：%s", len(batch), sizer.size, e)
+                    else:
+                        sizer.record_success()
+                    pbar.update(len(batch))
+                    pbar.set_postfix(cost=f"${current_cost():.2f}")
+
+            async with aiohttp.ClientSession(connector=connector) as session:
+                with tqdm(total=len(pending), desc="分析進度") as pbar:
+                    await asyncio.gather(
+                        producer(),
+                        *[worker(session, pbar) for _ in range(CONCURRENCY)],
+                    )
+
+        # 最終輸出：把去重後的結果（每個代表 id 四筆）展開回所有原始 id
+        all_results = []
+        for orig in orig_items:
+            rep = str(rep_of[orig["id"]])
+            if rep not in done:
+                logger.warning("找不到 id=%s 的結果（模型可能漏回）", orig["id"])
+                continue
+            for suffix, rec in done[rep]:
+                rid = f"{orig['id']}_{suffix}" if suffix else rec.get("id")
+                all_results.append({**rec, "id": rid})
 
-        save_json(output_path, all_results)  # 直接存 array，比較通用
+        save_jsonl(output_path, all_results)
         print(f"\n✅ 完成：{output_path}\n📝 原始回應紀錄：{raw_log_path}")
 
     except Exception as e:
@@ -202,4 +414,4 @@ def main(
 
 if __name__ == "__main__":
     # 只跑前 10 的範例：把 only_first_10=True 即可
-    main(only_first_10=True)
+    asyncio.run(main(only_first_10=True))